@@ -75,7 +75,8 @@ def build_parser():
                         type=int,
                         default=4,
                         help=("The compression level to use, from 0 to 9. "
-                              "If ZSTD is used, compression is supported up to 19. "
+                              "If ZSTD is used, levels up to 22 are supported, and "
+                              "negative levels select its faster modes. "
                               "Higher numbers decrease output file size at "
                               "the expense of compression time. Default is 4."))
     parser.add_argument("--n-threads", "-j",
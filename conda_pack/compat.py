@@ -13,8 +13,6 @@ PY2 = sys.version_info.major == 2
 if PY2:
     from imp import load_source
 
-    from Queue import Queue
-
     def source_from_cache(path):
         if path.endswith('.pyc') or path.endswith('.pyo'):
             return path[:-1]
@@ -22,7 +20,6 @@ if PY2:
 else:
     import importlib
     from importlib.util import source_from_cache
-    from queue import Queue  # noqa
 
     def load_source(name, path):
         loader = importlib.machinery.SourceFileLoader(name, path)
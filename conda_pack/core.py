@@ -4,6 +4,7 @@ import os
 import re
 import shlex
 import shutil
+import stat
 import subprocess
 import sys
 import tempfile
@@ -11,7 +12,9 @@ import warnings
 from contextlib import contextmanager
 from datetime import datetime
 from fnmatch import fnmatch
+from functools import lru_cache
 from pathlib import Path
+from typing import List, Optional, TypedDict
 
 import pkg_resources
 
@@ -33,6 +36,8 @@ PREFIX_PLACEHOLDER = ('/opt/anaconda1anaconda2'
 
 BIN_DIR = 'Scripts' if on_win else 'bin'
 
+_output_buffer_size = 2**20
+
 _current_dir = os.path.dirname(__file__)
 if on_win:
     _scripts = [(os.path.join(_current_dir, 'scripts', 'windows', 'activate.bat'),
@@ -366,9 +371,10 @@ class CondaEnv:
             Whether to overwrite any existing archive at the output path if present, or
             create the output directory structure if it's missing. Default is False.
         compress_level : int, optional
-            The compression level to use, from 0 to 9. If ZSTD is used, compression is
-            supported up to 19. Higher numbers decrease output file size at the expense of
-            compression time. Ignored for ``format='zip'``. Default is 4.
+            The compression level to use, from 0 to 9. If ZSTD is used, levels up to
+            22 are supported, and negative levels select its faster modes. Higher
+            numbers decrease output file size at the expense of compression time.
+            Default is 4.
         n_threads : int, optional
             The number of threads to use. Set to -1 to use the number of cpus
             on this machine. If a file format doesn't support threaded
@@ -422,7 +428,9 @@ class CondaEnv:
                 mtime = history_file.lstat().st_mtime
             else:
                 mtime = None
-            with os.fdopen(fd, "wb") as temp_file:
+            # Archive formats write many small pieces (e.g. 512 byte tar
+            # headers), so use a larger buffer than the default 8 KiB
+            with os.fdopen(fd, "wb", buffering=_output_buffer_size) as temp_file:
                 with archive(
                     temp_file,
                     temp_path,
@@ -551,9 +559,9 @@ def pack(
         Whether to overwrite any existing archive at the output path if present, or
         create the output directory structure if it's missing. Default is False.
     compress_level : int, optional
-        The compression level to use, from 0 to 9. If ZSTD is used, compression is
-        supported up to 19. Higher numbers decrease output file size at the expense
-        of compression time. Ignored for ``format='zip'``. Default is 4.
+        The compression level to use, from 0 to 9. If ZSTD is used, levels up to 22
+        are supported, and negative levels select its faster modes. Higher numbers
+        decrease output file size at the expense of compression time. Default is 4.
     zip_symlinks : bool, optional
         (``zip`` format only) Symbolic links aren't supported by the Zip standard,
         but are supported by *many* common Zip implementations. If ``True``, symbolic
@@ -632,14 +640,19 @@ def pack(
     )
 
 
+# conda-meta records are named ``{name}-{version}-{build}.json``, and neither
+# the version nor the build string may contain a dash. Matching the filename
+# excludes packages like ``python-dateutil`` without reading their metadata.
+_python_meta_pattern = re.compile(r'python-(\d[^-]*)-[^-]*\.json$')
+
+
 def find_site_packages(prefix):
     # Ensure there is at most one version of python installed
     pythons = []
-    for fn in glob.glob(os.path.join(prefix, 'conda-meta', 'python-*.json')):
-        with open(fn) as fil:
-            meta = json.load(fil)
-        if meta['name'] == 'python':
-            pythons.append(meta)
+    for fn in os.listdir(os.path.join(prefix, 'conda-meta')):
+        match = _python_meta_pattern.match(fn)
+        if match is not None:
+            pythons.append(match.group(1))
 
     if len(pythons) > 1:  # pragma: nocover
         raise CondaPackException("Unexpected failure, multiple versions of "
@@ -653,7 +666,7 @@ def find_site_packages(prefix):
     if on_win:
         return 'Lib/site-packages'
 
-    python_version = pythons[0]['version']
+    python_version = pythons[0]
     major_minor = ".".join(python_version.split(".")[:2])
 
     return 'lib/python%s/site-packages' % major_minor
@@ -711,6 +724,26 @@ def name_to_prefix(name=None):
     return prefix
 
 
+def noarch_type_from_meta(info, pkg):
+    """The noarch type of a package, given its ``conda-meta`` record.
+
+    Conda versions that write ``paths_data`` into ``conda-meta`` also record
+    the ``noarch`` type there, so the package cache only has to be consulted
+    for records written by older versions."""
+    if 'noarch' in info:
+        noarch_type = info['noarch']
+        if isinstance(noarch_type, dict):
+            noarch_type = noarch_type.get('type')
+        return noarch_type
+    elif 'paths_data' in info:
+        # conda copies ``noarch`` from the package's index.json into the
+        # record, and has done so since it started writing ``paths_data``.
+        # A record with ``paths_data`` but no ``noarch`` is therefore not a
+        # noarch package, and info/ would only say the same.
+        return None
+    return read_noarch_type(pkg)
+
+
 def read_noarch_type(pkg):
     for file_name in ['link.json', 'package_metadata.json']:
         path = os.path.join(pkg, 'info', file_name)
@@ -738,61 +771,128 @@ def read_has_prefix(path):
     return out
 
 
-def load_files(prefix):
-    from os.path import isfile, islink, join, relpath
-
-    ignore = {
-        "pkgs",
-        "envs",
-        "conda-bld",
-        ".conda_lock",
-        "users",
-        "conda-recipes",
-        ".index",
-        ".unionfs",
-        ".nonadmin",
-        "python.app",
-        "Launcher.app",
-    }
+# Top-level entries in a prefix that are never packed
+_ignored_names = frozenset({
+    "pkgs",
+    "envs",
+    "conda-bld",
+    ".conda_lock",
+    "users",
+    "conda-recipes",
+    ".index",
+    ".unionfs",
+    ".nonadmin",
+    "python.app",
+    "Launcher.app",
+})
+_ignored_suffixes = ('~', '.DS_STORE')
+
+# Older versions of conda insert unmanaged conda, activate, and deactivate
+# scripts into child environments upon activation. These are never packed.
+_unmanaged_scripts = ('conda', 'activate', 'deactivate')
+if on_win:
+    # Windows includes the POSIX and .bat versions of each
+    _unmanaged_scripts += ('conda.bat', 'activate.bat', 'deactivate.bat')
+_unmanaged_scripts = frozenset(os.path.join(BIN_DIR, f) for f in _unmanaged_scripts)
 
-    res = set()
 
-    for fn in os.listdir(prefix):
-        if fn in ignore or fn.endswith('~') or fn.endswith('.DS_STORE'):
+def _walk_files(path, relpath, res):
+    """Add everything under the directory ``path`` to ``res``.
+
+    Paths are added relative to the prefix, ``relpath`` being the relative
+    path of ``path`` itself. Symbolic links to directories and empty
+    directories are added directly. The file types reported by
+    ``os.scandir`` are used, so no extra ``stat`` call is needed per entry.
+    """
+    sep = os.sep
+    stack = [(path, relpath)]
+    while stack:
+        path, relpath = stack.pop()
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            # Unreadable directory, skipped as `os.walk` would
             continue
-        elif isfile(join(prefix, fn)):
-            res.add(fn)
-        elif islink(join(prefix, fn)):
-            res.add(fn)
-        else:
-            for root, dirs, files in os.walk(join(prefix, fn)):
-                root2 = relpath(root, prefix)
-                res.update(join(root2, fn2) for fn2 in files)
 
-                for d in dirs:
-                    if islink(join(root, d)):
-                        # Add symbolic directory directly
-                        res.add(join(root2, d))
+        if not entries:
+            # relpath is an empty directory, add it
+            res.add(relpath)
+
+        # Entry names never contain a separator, so plain concatenation is
+        # equivalent to (and much cheaper than) `os.path.join` here.
+        parent = relpath + sep
+        for entry in entries:
+            target = parent + entry.name
+            if entry.is_dir() and not entry.is_symlink():
+                stack.append((entry.path, target))
+            else:
+                res.add(target)
 
-                if not dirs and not files:
-                    # root2 is an empty directory, add it
-                    res.add(root2)
+
+def load_files(prefix):
+    res = set()
+
+    with os.scandir(prefix) as it:
+        for entry in it:
+            fn = entry.name
+            if fn in _ignored_names or fn.endswith(_ignored_suffixes):
+                continue
+            elif entry.is_file() or entry.is_symlink():
+                res.add(fn)
+            elif entry.is_dir():
+                _walk_files(entry.path, fn, res)
 
     return res
 
 
-def managed_file(is_noarch, site_packages, pkg, _path, prefix_placeholder=None,
-                 file_mode=None, **ignored):
-    if is_noarch:
-        if _path.startswith('site-packages/'):
-            target = site_packages + _path[13:]
-        elif _path.startswith('python-scripts/'):
-            target = BIN_DIR + _path[14:]
-        else:
-            target = _path
-    else:
-        target = _path
+class _PathRecord(TypedDict, total=False):
+    _path: str
+    prefix_placeholder: Optional[str]
+    file_mode: Optional[str]
+
+
+class _PathsJson(TypedDict):
+    paths: List[_PathRecord]
 
+
+def read_paths_json(path):
+    """Read the file records from a package's ``info/paths.json``.
+
+    If ``msgspec`` is installed, the file is decoded against a schema holding
+    only the fields conda-pack uses. Everything else (hashes, sizes, etc...)
+    is skipped by the decoder instead of being materialized and discarded.
+    """
+    with open(path, 'rb') as fil:
+        data = fil.read()
+    decoder = _paths_json_decoder()
+    if decoder is None:
+        return json.loads(data)['paths']
+    return decoder.decode(data)['paths']
+
+
+@lru_cache(maxsize=None)
+def _paths_json_decoder():
+    # A single decoder is shared by all packages, so the schema is only
+    # processed once (and a missing msgspec only looked up once).
+    try:
+        import msgspec
+    except ImportError:
+        return None
+    return msgspec.json.Decoder(_PathsJson)
+
+
+def noarch_target(site_packages, _path):
+    if _path.startswith('site-packages/'):
+        return site_packages + _path[13:]
+    elif _path.startswith('python-scripts/'):
+        return BIN_DIR + _path[14:]
+    return _path
+
+
+def managed_file(is_noarch, site_packages, pkg, _path, prefix_placeholder=None,
+                 file_mode=None):
+    target = noarch_target(site_packages, _path) if is_noarch else _path
     return File(os.path.join(pkg, _path),
                 target,
                 is_conda=True,
@@ -800,10 +900,32 @@ def managed_file(is_noarch, site_packages, pkg, _path, prefix_placeholder=None,
                 file_mode=file_mode)
 
 
+def _load_paths_managed(pkg, paths):
+    # Records are indexed directly rather than splatted into ``managed_file``,
+    # this loop runs once per file in every package. Joining with the package
+    # directory is resolved once up front, and ``File`` is called positionally
+    # (source, target, is_conda, file_mode, prefix_placeholder).
+    base = os.path.join(pkg, '')
+    return [File(base + r['_path'], r['_path'], True,
+                 r.get('file_mode'), r.get('prefix_placeholder'))
+            for r in paths]
+
+
+def _load_paths_noarch(pkg, site_packages, paths):
+    base = os.path.join(pkg, '')
+    return [File(base + r['_path'], noarch_target(site_packages, r['_path']), True,
+                 r.get('file_mode'), r.get('prefix_placeholder'))
+            for r in paths]
+
+
 def load_managed_package(info, prefix, site_packages, all_files):
+    """Load the files of a package installed from the package cache.
+
+    Returns the list of files, and the set of their (normcased) targets.
+    """
     pkg = info['link']['source']
 
-    noarch_type = read_noarch_type(pkg)
+    noarch_type = noarch_type_from_meta(info, pkg)
 
     is_noarch = noarch_type == 'python'
 
@@ -814,14 +936,14 @@ def load_managed_package(info, prefix, site_packages, all_files):
 
     paths_json = os.path.join(pkg, 'info', 'paths.json')
     if os.path.exists(paths_json):
-        with open(paths_json) as fil:
-            paths = json.load(fil)
-
-        files = [managed_file(is_noarch, site_packages, pkg, **r)
-                 for r in paths['paths']]
+        paths = read_paths_json(paths_json)
+        if is_noarch:
+            files = _load_paths_noarch(pkg, site_packages, paths)
+        else:
+            files = _load_paths_managed(pkg, paths)
     else:
         with open(os.path.join(pkg, 'info', 'files')) as fil:
-            paths = [f.strip() for f in fil]
+            paths = [f for f in (ln.strip() for ln in fil.read().split('\n')) if f]
 
         has_prefix = os.path.join(pkg, 'info', 'has_prefix')
 
@@ -833,21 +955,22 @@ def load_managed_package(info, prefix, site_packages, all_files):
             files = [managed_file(is_noarch, site_packages, pkg, p)
                      for p in paths]
 
+    targets = {os.path.normcase(i.target) for i in files}
     if is_noarch:
-        seen = {os.path.normcase(i.target) for i in files}
         for fil in info['files']:
             # If the path hasn't been added yet, *and* the path isn't a pyc
             # file that failed to bytecode compile (e.g. a file that contains
             # py3 only features in a py2 env), then add the path.
             fil_normed = os.path.normcase(fil)
-            if (fil_normed not in seen and not
+            if (fil_normed not in targets and not
                     ((fil_normed == ".nonadmin") or
                      (fil_normed.endswith('.pyc') and fil_normed not in all_files))):
                 file_mode = 'unknown' if fil.startswith(BIN_DIR) else None
                 f = File(os.path.join(prefix, fil), fil, is_conda=True,
                          prefix_placeholder=None, file_mode=file_mode)
                 files.append(f)
-    return files
+                targets.add(fil_normed)
+    return files, targets
 
 
 _uncached_error = """
@@ -917,12 +1040,12 @@ def load_environment(prefix, on_missing_cache='warn', ignore_editable_packages=F
                 new_files = [File(os.path.join(prefix, f), f, is_conda=True,
                                   prefix_placeholder=None, file_mode='unknown')
                              for f in info['files'] if f != '.nonadmin']
+                targets = {os.path.normcase(f.target) for f in new_files}
                 uncached.append((info['name'], info['version'], info['url']))
             else:
-                new_files = load_managed_package(info, prefix, site_packages,
-                                                 all_files)
+                new_files, targets = load_managed_package(info, prefix,
+                                                          site_packages, all_files)
 
-            targets = {os.path.normcase(f.target) for f in new_files}
             new_missing = targets.difference(all_files)
 
             if new_missing:
@@ -974,20 +1097,18 @@ def load_environment(prefix, on_missing_cache='warn', ignore_editable_packages=F
 
     # Add unmanaged files, preserving their original case
     unmanaged = {fn for fn_l, fn in all_files.items() if fn_l not in managed}
-    # Older versions of conda insert unmanaged conda, activate, and deactivate
-    # scripts into child environments upon activation. Remove these
-    fnames = ('conda', 'activate', 'deactivate')
-    if on_win:
-        # Windows includes the POSIX and .bat versions of each
-        fnames = fnames + ('conda.bat', 'activate.bat', 'deactivate.bat')
-    unmanaged -= {os.path.join(BIN_DIR, f) for f in fnames}
+    unmanaged -= _unmanaged_scripts
 
+    # Bytecode for a managed source file is left out. Only files within a
+    # `__pycache__` directory can be bytecode, which saves resolving (and
+    # failing on) the source path of every other unmanaged file.
     files.extend(File(os.path.join(prefix, p),
                       p,
                       is_conda=False,
                       prefix_placeholder=None,
                       file_mode='unknown')
-                 for p in unmanaged if not find_py_source(p) in managed)
+                 for p in unmanaged
+                 if '__pycache__' not in p or find_py_source(p) not in managed)
 
     if uncached and on_missing_cache in ('warn', 'raise'):
         packages = '\n'.join('- %s=%r   %s' % i for i in uncached)
@@ -999,6 +1120,9 @@ def load_environment(prefix, on_missing_cache='warn', ignore_editable_packages=F
     return files
 
 
+_shebang_pattern = re.compile(SHEBANG_REGEX, re.MULTILINE)
+
+
 def rewrite_shebang(data, target, prefix):
     """Rewrite a shebang header to ``#!usr/bin/env program...``.
 
@@ -1008,7 +1132,7 @@ def rewrite_shebang(data, target, prefix):
     fixed : bool
         Whether the file was successfully fixed in the rewrite.
     """
-    shebang_match = re.match(SHEBANG_REGEX, data, re.MULTILINE)
+    shebang_match = _shebang_pattern.match(data)
     prefix_b = prefix.encode('utf-8')
 
     if shebang_match:
@@ -1102,6 +1226,13 @@ if __name__ == '__main__':
             prog='conda-unpack',
             description=('Finish unpacking the environment after unarchiving. '
                          'Cleans up absolute prefixes in any remaining files'))
+    parser.add_argument('--n-threads', '-j',
+                        metavar='N',
+                        type=int,
+                        default=1,
+                        help=('The number of files to rewrite at once. Set to -1 '
+                              'to use the number of cpus on this machine. '
+                              'Default is 1.'))
     parser.add_argument('--version',
                         action='store_true',
                         help='Show version then exit')
@@ -1110,13 +1241,30 @@ if __name__ == '__main__':
     if args.version:
         print('conda-unpack {version}')
     else:
+        if args.n_threads == -1:
+            args.n_threads = os.cpu_count() or 1
+        elif args.n_threads < 1:
+            parser.error('n-threads must be >= 1, or -1 for all cores')
         script_dir = os.path.dirname(__file__)
         new_prefix = os.path.abspath(os.path.dirname(script_dir))
-        for path, placeholder, mode in _prefix_records:
+
+        def update(record):
+            path, placeholder, mode = record
             new_path = os.path.join(new_prefix, path)
             if on_win:
                 new_path = new_path.replace('\\\\', '/')
             update_prefix(new_path, new_prefix, placeholder, mode=mode)
+
+        if args.n_threads == 1:
+            for record in _prefix_records:
+                update(record)
+        else:
+            # Rewriting is mostly file I/O (and codesign on Apple silicon),
+            # which release the GIL, so threads are enough to overlap it
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(args.n_threads) as executor:
+                for _ in executor.map(update, _prefix_records):
+                    pass
 """
 
 
@@ -1130,6 +1278,16 @@ def is_binary_file(data):
         return True
 
 
+def _is_dir_or_link(path):
+    """Equivalent to ``os.path.isdir(path) or os.path.islink(path)``, but with
+    a single ``lstat`` call."""
+    try:
+        mode = os.lstat(path).st_mode
+    except (OSError, ValueError):
+        return False
+    return stat.S_ISDIR(mode) or stat.S_ISLNK(mode)
+
+
 class Packer:
     def __init__(self, prefix, archive, dest_prefix=None, parcel=None):
         self.prefix = prefix
@@ -1171,7 +1329,7 @@ class Packer:
         elif file.file_mode not in ('text', 'binary', 'unknown'):
             raise ValueError("unknown file_mode: %r" % file.file_mode)  # pragma: no cover
 
-        elif os.path.isdir(file.source) or os.path.islink(file.source):
+        elif _is_dir_or_link(file.source):
             self.archive.add(file.source, file.target)
             return
 
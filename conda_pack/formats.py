@@ -7,18 +7,106 @@ import struct
 import subprocess
 import tarfile
 import tempfile
-import threading
 import time
 import zipfile
 import zlib
-from contextlib import closing
-from functools import partial
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from io import BytesIO
-from multiprocessing.pool import ThreadPool
 
-from .compat import Queue, on_win
+from .compat import on_win
 from .core import CondaPackException
 
+try:
+    # zlib-ng is a drop-in replacement for zlib, with much faster (SIMD)
+    # deflate and crc32 implementations. Its output is a valid deflate
+    # stream, but not necessarily byte-identical to zlib's.
+    from zlib_ng import zlib_ng as _zlib
+except ImportError:
+    try:
+        # Intel's ISA-L is faster still, but only has compression levels 0-3
+        from isal import isal_zlib as _zlib
+    except ImportError:
+        _zlib = zlib
+
+
+def _deflate_level(level):
+    """Map a zlib compression level (0-9) onto the deflate backend's range"""
+    best = getattr(_zlib, 'ISAL_BEST_COMPRESSION', None)
+    if best is None:
+        return level
+    return min(level * (best + 1) // 10, best)
+
+
+def _gf2_matrix_times(mat, vec):
+    out = 0
+    for row in mat:
+        if not vec:
+            break
+        if vec & 1:
+            out ^= row
+        vec >>= 1
+    return out
+
+
+@lru_cache(maxsize=None)
+def _crc32_zeros_operator(k):
+    """The GF(2) operator that appends 2**k zero bytes to a crc32"""
+    if k == 0:
+        # Operator for a single zero bit, squared three times
+        op = (0xedb88320,) + tuple(1 << n for n in range(31))
+        n_squares = 3
+    else:
+        op = _crc32_zeros_operator(k - 1)
+        n_squares = 1
+    for _ in range(n_squares):
+        op = tuple(_gf2_matrix_times(op, row) for row in op)
+    return op
+
+
+def _crc32_combine_python(crc1, crc2, len2):
+    """Pure python version of zlib's ``crc32_combine``"""
+    k = 0
+    while len2:
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(_crc32_zeros_operator(k), crc1)
+        len2 >>= 1
+        k += 1
+    return crc1 ^ crc2
+
+
+@lru_cache(maxsize=None)
+def _libz_crc32_combine():
+    """``crc32_combine64`` from the system zlib, or None if unavailable"""
+    import ctypes
+    import ctypes.util
+    path = ctypes.util.find_library('z')
+    if path is None:
+        return None
+    try:
+        func = ctypes.CDLL(path).crc32_combine64
+    except (OSError, AttributeError):
+        return None
+    func.restype = ctypes.c_ulong
+    func.argtypes = [ctypes.c_ulong, ctypes.c_ulong, ctypes.c_int64]
+    return func
+
+
+def _crc32_combine_fallback(crc1, crc2, len2):
+    """Combine the crc32 of two buffers, given the length of the second.
+
+    Same as ``zlib.crc32_combine`` in the C library, which isn't exposed
+    by the stdlib ``zlib`` module. The system zlib's is used through
+    ctypes if it can be found, with a pure python fallback."""
+    libz_combine = _libz_crc32_combine()
+    if libz_combine is not None:
+        return libz_combine(crc1, crc2, len2)
+    return _crc32_combine_python(crc1, crc2, len2)
+
+
+_crc32_combine = getattr(_zlib, 'crc32_combine', _crc32_combine_fallback)
+
 
 def _parse_n_threads(n_threads=1):
     if n_threads == -1:
@@ -47,7 +135,8 @@ def archive(
 
     if format == 'zip':
         return ZipArchive(fileobj, arcroot, compresslevel=compress_level,
-                          zip_symlinks=zip_symlinks, zip_64=zip_64)
+                          zip_symlinks=zip_symlinks, zip_64=zip_64,
+                          n_threads=n_threads)
 
     # Tar archives
     if format in ('tar.gz', 'tgz', 'parcel'):
@@ -85,7 +174,8 @@ def archive(
         # python's tarfile doesn't support zstd natively yet
         mode = "w"
         close_file = True
-        fileobj = ParallelZstdFileWriter(fileobj)
+        fileobj = ParallelZstdFileWriter(fileobj, compresslevel=compress_level,
+                                         n_threads=n_threads)
     elif format == "squashfs":
         return SquashFSArchive(fileobj, path, arcroot, n_threads, verbose=verbose,
                                compress_level=compress_level)
@@ -108,7 +198,19 @@ class ParallelZstdFileWriter:
     def __init__(self, fileobj, compresslevel=9, n_threads=1, mtime=None):
         import zstandard
 
-        self.cctx = zstandard.ZstdCompressor(level=compresslevel, threads=n_threads)
+        # libzstd does the block splitting, framing and threading itself.
+        # threads=0 compresses on the calling thread, while any positive
+        # value hands the work off to that many background workers.
+        # Long distance matching over a 128 MiB window finds the many
+        # duplicated files in an environment. 2**27 is also the largest
+        # window zstd decompressors accept without extra options.
+        params = zstandard.ZstdCompressionParameters.from_level(
+            compresslevel,
+            threads=n_threads if n_threads > 1 else 0,
+            enable_ldm=True,
+            window_log=27,
+        )
+        self.cctx = zstandard.ZstdCompressor(compression_params=params)
         self.compressor = self.cctx.stream_writer(fileobj)
 
     def write(self, data: bytes):
@@ -136,61 +238,108 @@ class ParallelFileWriter:
         self._write_header()
 
         # Parallel initialization
-        self.buffers = []
-        self.buffer_length = 0
-
-        self.pool = ThreadPool(n_threads)
-        self.compress_queue = Queue(maxsize=n_threads)
-
-        self._consumer_thread = threading.Thread(target=self._consumer)
-        self._consumer_thread.daemon = True
-        self._consumer_thread.start()
+        self._dictionary = None
+        # Block buffers are preallocated, filled in place and recycled once
+        # their compressed output is written, so the steady state doesn't
+        # allocate a new block per submission. The first block starts empty
+        # and grows with the data instead, so a small archive doesn't pay
+        # for a whole block up front.
+        self._free_blocks = []
+        self.buffer = bytearray()
+        self._fill = 0
+
+        # The pool is only started once a first full block is submitted, so
+        # archives smaller than a block never start any threads
+        self.pool = None
+        self._pending = deque()
+        # At most this many blocks are compressing or waiting to be written,
+        # which bounds memory use to about (2 * n_threads + 1) blocks while
+        # leaving a full block of queued work for each worker.
+        self._max_pending = 2 * n_threads
 
     def tell(self):
         return self.size
 
     def write(self, data):
-        if not isinstance(data, bytes):
-            data = memoryview(data)
-        n = len(data)
+        # Any bytes-like object is accepted. Its contents are copied into the
+        # current block straight away, so the caller is free to reuse it.
+        view = memoryview(data).cast('B')
+        n = len(view)
         if n > 0:
-            self._per_buffer_op(data)
             self.size += n
-            self.buffer_length += n
-            self.buffers.append(data)
-            if self.buffer_length > self._block_size:
-                self.compress_queue.put(self.buffers)
-                self.buffers = []
-                self.buffer_length = 0
+            # Writes (e.g. 512 byte tar headers) are gathered into a single
+            # contiguous block, so workers make one compressor call per block
+            while view:
+                k = min(len(view), self._block_size - self._fill)
+                # Extends the first block while it is still growing
+                self.buffer[self._fill:self._fill + k] = view[:k]
+                self._fill += k
+                view = view[k:]
+                if self._fill == self._block_size:
+                    self._submit(self.buffer)
+                    self.buffer = self._new_block()
+                    self._fill = 0
         return n
 
-    def _consumer(self):
-        with closing(self.pool):
-            for buffers in self.pool.imap(
-                    self._compress, iter(self.compress_queue.get, None)):
-                for buf in buffers:
-                    if len(buf):
-                        self.fileobj.write(buf)
-
-    def _compress(self, in_bufs):
-        out_bufs = []
-        compressor = self._new_compressor()
-        for data in in_bufs:
-            out_bufs.append(compressor.compress(data))
-        out_bufs.append(self._flush_compressor(compressor))
-        return out_bufs
+    def _new_block(self):
+        if self._free_blocks:
+            return self._free_blocks.pop()
+        return bytearray(self._block_size)
+
+    def _submit(self, block):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.n_threads)
+        self._pending.append((
+            block,
+            self.pool.submit(self._compress, (block, self._dictionary))
+        ))
+        self._dictionary = self._next_dictionary(block)
+        # The producer writes finished blocks out in order itself, instead of
+        # handing them to a separate consumer thread. It only blocks on a
+        # result once the cap on in-flight blocks is reached.
+        pending = self._pending
+        while pending and (len(pending) >= self._max_pending
+                           or pending[0][1].done()):
+            self._write_result()
+
+    def _write_result(self):
+        block, result = self._pending.popleft()
+        self._write_compressed(*result.result())
+        if isinstance(block, bytearray):
+            self._free_blocks.append(block)
+
+    def _write_compressed(self, data, check):
+        self._combine_check(check)
+        self.fileobj.write(data)
+
+    def _compress(self, item):
+        data, dictionary = item
+        compressor = self._new_compressor(dictionary)
+        # Joined here, on the worker, so each block is a single write
+        out = compressor.compress(data) + self._flush_compressor(compressor)
+        return out, self._block_check(data)
+
+    def _next_dictionary(self, block):
+        return None
 
     def close(self):
         if self.fileobj is None:
             return
 
         # Flush any waiting buffers
-        if self.buffers:
-            self.compress_queue.put(self.buffers)
+        if self._fill:
+            block = memoryview(self.buffer)[:self._fill]
+            if self.pool is None:
+                # Everything fit in a single block, compress it right here
+                self._write_compressed(*self._compress((block, self._dictionary)))
+            else:
+                self._submit(block)
 
         # Wait for all work to finish
-        self.compress_queue.put(None)
-        self._consumer_thread.join()
+        while self._pending:
+            self._write_result()
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
 
         # Write the closing bytes
         self._write_footer()
@@ -199,49 +348,68 @@ class ParallelFileWriter:
         self.fileobj.flush()
 
         # Cache shutdown state
-        self.compress_queue = None
+        self._pending = None
+        self._free_blocks = None
+        self.buffer = None
         self.pool = None
         self.fileobj = None
 
 
-class ParallelGzipFileWriter(ParallelFileWriter):
-    # Since it's hard for us to keep a running dictionary (a serial operation)
-    # with parallel compression of blocks, we use a blocksize > a few factors
-    # bigger than the max dict size (32 KiB). In practice this is fine - we
-    # only lose out by a small factor of unneeded redundancy, and real files
-    # often lack enough redundant byte sequences to make this significant. Pigz
-    # uses 128 KiB, but does more work to keep a running dict.
-    _block_size = 256 * 2**10
-
-    def _init_state(self):
-        self.crc = zlib.crc32(b"") & 0xffffffff
+# magic and method, flags, mtime, extra flags (max compression), os (unknown)
+_gzip_header = struct.Struct("<3sBLBB")
+# crc32, uncompressed size mod 2**32
+_gzip_footer = struct.Struct("<LL")
 
-    def _new_compressor(self):
-        return zlib.compressobj(self.compresslevel, zlib.DEFLATED,
-                                -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
 
-    def _per_buffer_op(self, buffer):
-        self.crc = zlib.crc32(buffer, self.crc) & 0xffffffff
+class ParallelGzipFileWriter(ParallelFileWriter):
+    # Blocks are compressed independently, but like pigz each block is primed
+    # with the last 32 KiB (the max deflate window) of the previous block as
+    # a preset dictionary. The output is still a single deflate stream, so
+    # this recovers most of the ratio lost by splitting the input into blocks.
+    _block_size = 128 * 2**10
+    _dictionary_size = 32 * 2**10
 
-    def _write32u(self, value):
-        self.fileobj.write(struct.pack("<L", value))
+    def _init_state(self):
+        self.crc = _zlib.crc32(b"") & 0xffffffff
+        self._level = _deflate_level(self.compresslevel)
+
+    def _new_compressor(self, dictionary=None):
+        # A preset dictionary can only be given on construction, so
+        # compressors can't be reused between blocks
+        if dictionary is None:
+            return _zlib.compressobj(self._level, _zlib.DEFLATED,
+                                     -_zlib.MAX_WBITS, _zlib.DEF_MEM_LEVEL, 0)
+        return _zlib.compressobj(self._level, _zlib.DEFLATED,
+                                 -_zlib.MAX_WBITS, _zlib.DEF_MEM_LEVEL, 0,
+                                 dictionary)
+
+    def _next_dictionary(self, block):
+        return bytes(block[-self._dictionary_size:])
+
+    def _block_check(self, block):
+        # Computed on the worker threads, then combined in order by the
+        # consumer, so the crc doesn't serialize the producer.
+        return _zlib.crc32(block), len(block)
+
+    def _combine_check(self, check):
+        self.crc = _crc32_combine(self.crc, *check) & 0xffffffff
 
     def _write_header(self):
-        self.fileobj.write(b'\037\213\010')
-        self.fileobj.write(b'\x00')
-        if self.mtime is not None:
-            self._write32u(int(self.mtime))
-        else:
-            self._write32u(int(time.time()))
-        self.fileobj.write(b'\002\377')
+        mtime = self.mtime if self.mtime is not None else time.time()
+        self.fileobj.write(
+            _gzip_header.pack(b'\037\213\010', 0, int(mtime), 2, 255)
+        )
 
     def _write_footer(self):
-        self.fileobj.write(self._new_compressor().flush(zlib.Z_FINISH))
-        self._write32u(self.crc)
-        self._write32u(self.size & 0xffffffff)
+        self.fileobj.write(
+            self._new_compressor().flush(_zlib.Z_FINISH)
+            + _gzip_footer.pack(self.crc, self.size & 0xffffffff)
+        )
 
     def _flush_compressor(self, compressor):
-        return compressor.flush(zlib.Z_FULL_FLUSH)
+        # The compressor is discarded after each block, so only the byte
+        # alignment matters here, not resetting its state
+        return compressor.flush(_zlib.Z_SYNC_FLUSH)
 
 
 class ParallelBZ2FileWriter(ParallelFileWriter):
@@ -249,11 +417,14 @@ class ParallelBZ2FileWriter(ParallelFileWriter):
         # bzip2 compresslevel dictates its blocksize of 100 - 900 kb
         self._block_size = self.compresslevel * 100 * 2**10
 
-    def _new_compressor(self):
+    def _new_compressor(self, dictionary=None):
         import bz2
         return bz2.BZ2Compressor(self.compresslevel)
 
-    def _per_buffer_op(self, buffer):
+    def _block_check(self, block):
+        pass
+
+    def _combine_check(self, check):
         pass
 
     def _write_header(self):
@@ -272,11 +443,14 @@ class ParallelXZFileWriter(ParallelFileWriter):
         # 2-4 times the size (minimum 1 MB) is best for the block size.
         self._block_size = 4 * max(1, (2**(self.compresslevel - 4))) * 2**10 * 2**10
 
-    def _new_compressor(self):
+    def _new_compressor(self, dictionary=None):
         import lzma
         return lzma.LZMACompressor(preset=self.compresslevel)
 
-    def _per_buffer_op(self, buffer):
+    def _block_check(self, block):
+        pass
+
+    def _combine_check(self, check):
         pass
 
     def _write_header(self):
@@ -290,13 +464,19 @@ class ParallelXZFileWriter(ParallelFileWriter):
 
 
 class ArchiveBase:
+    # Subclasses set _arcroot_prefix to os.path.join(arcroot, ''), so adding
+    # a file only needs a string concatenation rather than os.path.join.
     def add(self, source, target):
-        target = os.path.join(self.arcroot, target)
-        self._add(source, target)
+        self._add(source, self._arcroot_prefix + target)
 
     def add_bytes(self, source, sourcebytes, target):
-        target = os.path.join(self.arcroot, target)
-        self._add_bytes(source, sourcebytes, target)
+        self._add_bytes(source, sourcebytes, self._arcroot_prefix + target)
+
+
+# File contents are copied into the archive in chunks of this size, rather
+# than tarfile's default of 16 KiB. Fewer, larger writes mean fewer calls
+# through the (possibly parallel) compressing writer for large files.
+_tar_copy_bufsize = 2**20
 
 
 class TarArchive(ArchiveBase):
@@ -305,6 +485,7 @@ class TarArchive(ArchiveBase):
     ):
         self.fileobj = fileobj
         self.arcroot = arcroot
+        self._arcroot_prefix = os.path.join(arcroot, '')
         self.close_file = close_file
         self.mode = mode
         self.compresslevel = compresslevel
@@ -317,6 +498,7 @@ class TarArchive(ArchiveBase):
         self.archive = tarfile.open(fileobj=self.fileobj,
                                     dereference=on_win,
                                     mode=self.mode,
+                                    copybufsize=_tar_copy_bufsize,
                                     **kwargs)
         return self
 
@@ -354,22 +536,63 @@ for zip files unless the --zip-symlinks option is engaged. Please see
 tar-based archive format instead."""
 
 
+class _Deflated:
+    """Stands in for a zip entry's compressor when its data is already deflated"""
+    @staticmethod
+    def flush():
+        return b""
+
+
+# Attributes of the writer returned by ZipFile.open(..., 'w') that
+# ZipArchive._write_deflated sets directly. These are CPython internals.
+_zip_writer_attrs = ('_compressor', '_file_size', '_compress_size', '_crc')
+
+
+@lru_cache(maxsize=None)
+def _can_write_deflated():
+    """Whether this python's zipfile exposes the entry writer internals needed
+    to write already deflated data. If not, zip archives aren't deflated in
+    parallel."""
+    with zipfile.ZipFile(BytesIO(), 'w', compression=zipfile.ZIP_DEFLATED) as probe:
+        with probe.open('probe', 'w') as dest:
+            return all(hasattr(dest, name) for name in _zip_writer_attrs)
+
+
 class ZipArchive(ArchiveBase):
-    def __init__(self, fileobj, arcroot, compresslevel=4, zip_symlinks=False, zip_64=True):
+    # With n_threads > 1, files up to this size are read and deflated on
+    # worker threads, then written out in order on the main thread. Larger
+    # files are streamed through zipfile as usual, to bound memory use.
+    _max_parallel_size = 8 * 2**20
+
+    def __init__(self, fileobj, arcroot, compresslevel=4, zip_symlinks=False, zip_64=True,
+                 n_threads=1):
         self.fileobj = fileobj
         self.arcroot = arcroot
+        self._arcroot_prefix = os.path.join(arcroot, '')
         self.compresslevel = compresslevel
         self.zip_symlinks = zip_symlinks
         self.zip_64 = zip_64
+        self.n_threads = n_threads
 
     def __enter__(self):
         self.archive = zipfile.ZipFile(self.fileobj, "w",
                                        allowZip64=self.zip_64,
                                        compresslevel=self.compresslevel,
                                        compression=zipfile.ZIP_DEFLATED)
+        if self.n_threads > 1 and _can_write_deflated():
+            self._pool = ThreadPoolExecutor(max_workers=self.n_threads)
+            self._pending = deque()
+        else:
+            self._pool = None
         return self
 
     def __exit__(self, type, value, traceback):
+        if self._pool is not None:
+            try:
+                if value is None:
+                    self._write_pending()
+            finally:
+                self._pool.shutdown(wait=True)
         self.archive.close()
         if isinstance(value, zipfile.LargeZipFile):
             raise CondaPackException(
@@ -381,6 +604,7 @@ class ZipArchive(ArchiveBase):
             st = os.lstat(source)
             is_link = stat.S_ISLNK(st.st_mode)
         except (OSError, AttributeError):
+            st = None
             is_link = False
 
         if is_link:
@@ -390,20 +614,24 @@ class ZipArchive(ArchiveBase):
                 info.external_attr = (st.st_mode & 0xFFFF) << 16
                 if os.path.isdir(source):
                     info.external_attr |= 0x10  # MS-DOS directory flag
+                if self._pool is not None:
+                    self._write_pending()
                 self.archive.writestr(info, os.readlink(source))
             else:
                 if os.path.isdir(source):
                     for root, dirs, files in os.walk(source, followlinks=True):
                         root2 = os.path.join(target, os.path.relpath(root, source))
                         for fil in files:
-                            self.archive.write(os.path.join(root, fil),
-                                               os.path.join(root2, fil))
+                            self._write(os.path.join(root, fil),
+                                        os.path.join(root2, fil))
                         if not dirs and not files:
                             # root is an empty directory, write it now
+                            if self._pool is not None:
+                                self._write_pending()
                             self.archive.write(root, root2)
                 else:
                     try:
-                        self.archive.write(source, target)
+                        self._write(source, target)
                     except OSError as e:
                         if e.errno == errno.ENOENT:
                             if source[-len(target):] == target:
@@ -416,9 +644,67 @@ class ZipArchive(ArchiveBase):
                             raise CondaPackException(msg)
                         raise
         else:
+            self._write(source, target, st)
+
+    def _write(self, source, target, st=None):
+        if self._pool is None:
+            self.archive.write(source, target)
+            return
+        # Directories and large files go through ZipFile.write, which stats
+        # the source itself. Decide from the stat taken in _add if there is
+        # one, so they aren't stat'ed a third time by ZipInfo.from_file.
+        if st is not None and (stat.S_ISDIR(st.st_mode)
+                               or st.st_size > self._max_parallel_size):
+            self._write_pending()
+            self.archive.write(source, target)
+            return
+        info = zipfile.ZipInfo.from_file(source, target)
+        if info.is_dir() or info.file_size > self._max_parallel_size:
+            self._write_pending()
             self.archive.write(source, target)
+            return
+        info.compress_type = zipfile.ZIP_DEFLATED
+        # The file is read here rather than on a worker, since callers may
+        # remove it (e.g. temporary files) as soon as add() returns
+        with open(source, 'rb') as fil:
+            data = fil.read()
+        self._pending.append((info, self._pool.submit(self._deflate, data)))
+        pending = self._pending
+        while pending and (len(pending) >= 2 * self.n_threads or pending[0][1].done()):
+            info, future = pending.popleft()
+            self._write_deflated(info, future.result())
+
+    def _deflate(self, data):
+        compressor = _zlib.compressobj(_deflate_level(self.compresslevel),
+                                       _zlib.DEFLATED, -_zlib.MAX_WBITS)
+        return len(data), _zlib.crc32(data), compressor.compress(data) + compressor.flush()
+
+    def _write_deflated(self, info, result):
+        file_size, crc, data = result
+        # zipfile writes the local header and, on close, the sizes and crc.
+        # The data itself is already deflated, so bypass the entry's
+        # compressor and fill in its bookkeeping directly.
+        with self.archive.open(info, 'w') as dest:
+            dest._compressor = _Deflated
+            self.archive.fp.write(data)
+            dest._file_size = file_size
+            dest._compress_size = len(data)
+            dest._crc = crc
+        # zipfile copies these onto the ZipInfo on close. Check they made it
+        # there, rather than risk writing an entry with a bad crc or size.
+        if (info.CRC, info.file_size, info.compress_size) != (crc, file_size, len(data)):
+            raise CondaPackException(
+                "Failed to write pre-deflated zip entry %r, rerun with "
+                "--n-threads 1" % info.filename)
+
+    def _write_pending(self):
+        while self._pending:
+            info, future = self._pending.popleft()
+            self._write_deflated(info, future.result())
 
     def _add_bytes(self, source, sourcebytes, target):
+        if self._pool is not None:
+            self._write_pending()
         info = zipinfo_from_file(source, target)
         self.archive.writestr(info, sourcebytes)
 
@@ -435,6 +721,7 @@ class SquashFSArchive(ArchiveBase):
         # we don't need fileobj, just the name of the file
         self.target_path = target_path
         self.arcroot = arcroot
+        self._arcroot_prefix = os.path.join(arcroot, '')
         self.n_threads = n_threads
         self.verbose = verbose
         self.compress_level = compress_level
@@ -444,6 +731,10 @@ class SquashFSArchive(ArchiveBase):
         # hardlinks to files and make tmpfiles for bytes
         self._temp_dir = os.path.normpath(tempfile.mkdtemp())
         self._staging_dir = os.path.join(self._temp_dir, "squashfs-root")
+        # Every directory in the staging area is created by us, so they all
+        # share the device and owner of the temporary directory
+        self._staging_stat = os.lstat(self._temp_dir)
+        self._parent_dirs = set()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -493,7 +784,9 @@ class SquashFSArchive(ArchiveBase):
 
     def _ensure_parent(self, path):
         dir_path = os.path.dirname(path)
-        os.makedirs(dir_path, exist_ok=True)
+        if dir_path not in self._parent_dirs:
+            os.makedirs(dir_path, exist_ok=True)
+            self._parent_dirs.add(dir_path)
 
     def _add(self, source, target):
         target_abspath = self._absolute_path(target)
@@ -501,7 +794,7 @@ class SquashFSArchive(ArchiveBase):
 
         # hardlink instead of copy is faster, but it doesn't work across devices
         source_stat = os.lstat(source)
-        target_stat = os.lstat(os.path.dirname(target_abspath))
+        target_stat = self._staging_stat
         same_device = source_stat.st_dev == target_stat.st_dev
         same_user = source_stat.st_uid == target_stat.st_uid
 
@@ -512,10 +805,12 @@ class SquashFSArchive(ArchiveBase):
 
         # we overwrite if the same `target` is added twice
         # to be consistent with the tar-archive implementation
-        if os.path.lexists(target_abspath):
+        try:
             os.remove(target_abspath)
+        except FileNotFoundError:
+            pass
 
-        if os.path.isdir(source) and not os.path.islink(source):
+        if stat.S_ISDIR(source_stat.st_mode):
             # directories we add through copying the tree
             shutil.copytree(source,
                             target_abspath,
@@ -538,7 +833,9 @@ class NoArchive(ArchiveBase):
     def __init__(self, output, arcroot):
         self.output = output
         self.arcroot = arcroot
+        self._arcroot_prefix = os.path.join(arcroot, '')
         self.copy_func = None
+        self._parent_dirs = set()
 
     def __enter__(self):
         return self
@@ -551,20 +848,24 @@ class NoArchive(ArchiveBase):
 
     def _ensure_parent(self, path):
         dir_path = os.path.dirname(path)
-        os.makedirs(dir_path, exist_ok=True)
+        if dir_path not in self._parent_dirs:
+            os.makedirs(dir_path, exist_ok=True)
+            self._parent_dirs.add(dir_path)
 
     def _add(self, source, target):
         target_abspath = self._absolute_path(target)
         self._ensure_parent(target_abspath)
 
+        source_stat = os.lstat(source)
+
         # hardlink instead of copy is faster, but it doesn't work across devices
         if self.copy_func is None:
-            if os.lstat(source).st_dev == os.lstat(os.path.dirname(target_abspath)).st_dev:
+            if source_stat.st_dev == os.lstat(os.path.dirname(target_abspath)).st_dev:
                 self.copy_func = partial(os.link, follow_symlinks=False)
             else:
                 self.copy_func = partial(shutil.copy2, follow_symlinks=False)
 
-        if os.path.isfile(source) or os.path.islink(source):
+        if stat.S_ISREG(source_stat.st_mode) or stat.S_ISLNK(source_stat.st_mode):
             self.copy_func(source, target_abspath)
         else:
             os.mkdir(target_abspath)
@@ -35,8 +35,9 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import mmap
+import os
 import platform
-import re
 import struct
 import subprocess
 import sys
@@ -66,6 +67,10 @@ def update_prefix(path, new_prefix, placeholder, mode='text'):
 
     file_changed = False
     with open(path, 'rb+') as fh:
+        # Files without the placeholder are left as is, and a memory map lets
+        # us check that without reading them into memory
+        if not _contains_placeholder(fh, placeholder, mode):
+            return
         original_data = fh.read()
         fh.seek(0)
 
@@ -83,6 +88,23 @@ def update_prefix(path, new_prefix, placeholder, mode='text'):
         )
 
 
+def _contains_placeholder(fh, placeholder, mode):
+    if not os.fstat(fh.fileno()).st_size:
+        # Empty files can't be memory mapped
+        return False
+    placeholder = placeholder.encode('utf-8')
+    try:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # Some filesystems can't memory map files, let the caller read it
+        return True
+    with mm:
+        if mm.find(placeholder) != -1:
+            return True
+        # binary_replace also matches a lowercased placeholder on windows
+        return on_win and mode == 'binary' and mm.find(placeholder.lower()) != -1
+
+
 def replace_prefix(data, mode, placeholder, new_prefix):
     if mode == 'text':
         data2 = text_replace(data, placeholder, new_prefix)
@@ -120,16 +142,29 @@ else:
         """Perform a binary replacement of `data`, where ``placeholder`` is
         replaced with ``new_prefix`` and the remaining string is padded with null
         characters.  All input arguments are expected to be bytes objects."""
-
-        def replace(match):
-            occurances = match.group().count(placeholder)
+        # Each occurrence of placeholder up to the next null byte is a single
+        # C string to rewrite. This walks them with bytes.find rather than a
+        # regex, which is much faster on large binaries.
+        hit = data.find(placeholder)
+        if hit == -1:
+            return data
+        out = bytearray()
+        pos = 0
+        while hit != -1:
+            end = data.find(b'\0', hit + len(placeholder))
+            if end == -1:
+                break
+            occurances = data.count(placeholder, hit, end)
             padding = (len(placeholder) - len(new_prefix)) * occurances
             if padding < 0:
                 raise ValueError("negative padding")
-            return match.group().replace(placeholder, new_prefix) + b'\0' * padding
-
-        pat = re.compile(re.escape(placeholder) + b'([^\0]*?)\0')
-        return pat.sub(replace, data)
+            out += data[pos:hit]
+            out += data[hit:end].replace(placeholder, new_prefix)
+            out += b'\0' * (padding + 1)
+            pos = end + 1
+            hit = data.find(placeholder, pos)
+        out += data[pos:]
+        return bytes(out)
 
 
 def replace_pyzzer_entry_point_shebang(all_data, placeholder, new_prefix):
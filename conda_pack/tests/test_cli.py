@@ -1,14 +1,14 @@
 import os
 import signal
 import tarfile
-import time
-from threading import Thread
+from threading import Event, Thread
 
 import pytest
 
 import conda_pack
 from conda_pack.cli import main
 from conda_pack.compat import on_win
+from conda_pack.core import Packer
 
 from .conftest import basic_python_path, py310_path
 
@@ -70,7 +70,7 @@ def test_cli_roundtrip(capsys, tmpdir):
     out, err = capsys.readouterr()
     assert not err
 
-    bar, percent, time = (i.strip() for i in out.split("\r")[-1].split("|"))
+    bar, percent, time = (i.strip() for i in out.rpartition("\r")[2].split("|"))
     assert bar == "[" + "#" * 40 + "]"
     assert percent == "100% Completed"
     assert time
@@ -128,10 +128,23 @@ def test_cli_warnings(capsys, tmpdir):
 
 
 @pytest.mark.skipif(on_win, reason='SIGINT terminates the tests on Windows')
-def test_keyboard_interrupt(capsys, tmpdir):
+def test_keyboard_interrupt(capsys, tmpdir, monkeypatch):
+    # Interrupt as soon as the first file is packed, rather than after a
+    # fixed delay
+    packing = Event()
+    add = Packer.add
+
+    def add_and_signal(self, file):
+        packing.set()
+        add(self, file)
+
+    monkeypatch.setattr(Packer, "add", add_and_signal)
+
     def interrupt():
-        time.sleep(0.2)
-        os.kill(os.getpid(), signal.SIGINT)
+        # Only interrupt if packing actually started, so a failed pack
+        # doesn't leak a SIGINT into later tests
+        if packing.wait(timeout=5):
+            os.kill(os.getpid(), signal.SIGINT)
 
     interrupter = Thread(target=interrupt)
 
@@ -142,6 +155,8 @@ def test_keyboard_interrupt(capsys, tmpdir):
             main(["-p", basic_python_path, "-o", out_path])
     except KeyboardInterrupt:
         assert False, "Should have been caught by the CLI"
+    finally:
+        interrupter.join()
 
     assert exc.value.code == 1
     out, err = capsys.readouterr()
@@ -8,9 +8,16 @@ from glob import glob
 
 import pytest
 
-from conda_pack import CondaEnv, CondaPackException, pack
+from conda_pack import CondaEnv, CondaPackException, core, pack
 from conda_pack.compat import load_source, on_win
-from conda_pack.core import BIN_DIR, File, name_to_prefix
+from conda_pack.core import (
+    BIN_DIR,
+    File,
+    find_site_packages,
+    name_to_prefix,
+    noarch_type_from_meta,
+)
+from conda_pack.prefixes import binary_replace
 
 from .conftest import (
     activate_scripts_path,
@@ -228,6 +235,95 @@ def test_works_with_no_python():
     assert len(env)
 
 
+def test_find_site_packages(tmpdir):
+    conda_meta = tmpdir.mkdir("conda-meta")
+    conda_meta.join("python-dateutil-2.8.2-pyhd3eb1b0_0.json").write("{}")
+    conda_meta.join("python_abi-3.10-2_cp310.json").write("{}")
+    assert find_site_packages(str(tmpdir)) is None
+
+    conda_meta.join("python-3.10.4-h12debd9_0.json").write("{}")
+    expected = "Lib/site-packages" if on_win else "lib/python3.10/site-packages"
+    assert find_site_packages(str(tmpdir)) == expected
+
+
+def test_noarch_type_from_meta(tmpdir):
+    pkg = str(tmpdir)
+    assert noarch_type_from_meta({"noarch": "python"}, pkg) == "python"
+    assert noarch_type_from_meta({"noarch": {"type": "python"}}, pkg) == "python"
+
+    # Records written by older conda versions have neither key, so the noarch
+    # type comes from the package cache
+    tmpdir.mkdir("info").join("link.json").write(
+        json.dumps({"noarch": {"type": "python"}})
+    )
+    assert noarch_type_from_meta({}, pkg) == "python"
+
+    # A record with paths_data and no noarch key isn't noarch, whatever the
+    # package cache says
+    assert noarch_type_from_meta({"paths_data": {}}, pkg) is None
+
+
+def test_read_paths_json(tmpdir, monkeypatch):
+    pytest.importorskip("msgspec")
+    paths_json = {
+        "paths": [
+            {"_path": "bin/foo", "path_type": "hardlink",
+             "sha256": "0" * 64, "size_in_bytes": 10,
+             "file_mode": "text", "prefix_placeholder": "/opt/placeholder"},
+            {"_path": "lib/libfoo.so", "path_type": "hardlink",
+             "sha256": "1" * 64, "size_in_bytes": 20,
+             "file_mode": "binary", "prefix_placeholder": "/opt/placeholder"},
+            {"_path": "lib/foo.py", "path_type": "hardlink", "no_link": True},
+            {"_path": "share/foo"},
+        ],
+        "paths_version": 1,
+    }
+    path = str(tmpdir.join("paths.json"))
+    with open(path, "w") as fil:
+        json.dump(paths_json, fil)
+
+    def fields(records):
+        return [(r["_path"], r.get("file_mode"), r.get("prefix_placeholder"))
+                for r in records]
+
+    assert core._paths_json_decoder() is not None
+    with_msgspec = fields(core.read_paths_json(path))
+    monkeypatch.setattr(core, "_paths_json_decoder", lambda: None)
+    with_json = fields(core.read_paths_json(path))
+
+    assert with_msgspec == with_json == [
+        ("bin/foo", "text", "/opt/placeholder"),
+        ("lib/libfoo.so", "binary", "/opt/placeholder"),
+        ("lib/foo.py", None, None),
+        ("share/foo", None, None),
+    ]
+
+
+def test_load_managed_package_info_files(tmpdir):
+    pkg = tmpdir.mkdir("pkg")
+    # Same parsing as conda: lines are only split on newlines, then stripped
+    pkg.mkdir("info").join("files").write(
+        " bin/foo \n\nlib/form\x0cfeed\r\nshare/line\u2028sep\n"
+    )
+    info = {"link": {"source": str(pkg)}, "noarch": None}
+    files, _ = core.load_managed_package(info, str(tmpdir), None, set())
+    assert [f.target for f in files] == ["bin/foo", "lib/form\x0cfeed",
+                                         "share/line\u2028sep"]
+
+
+@pytest.mark.skipif(on_win, reason="Binary prefixes are padded on posix only")
+def test_binary_replace():
+    data = (b"head/old/prefix/lib\0/old/prefix:/old/prefix/bin\0xx"
+            b"/old/prefix/no-terminator")
+    res = binary_replace(data, b"/old/prefix", b"/new")
+    assert res == (b"head/new/lib\0\0\0\0\0\0\0\0/new:/new/bin\0" + b"\0" * 14 +
+                   b"xx/old/prefix/no-terminator")
+    assert len(res) == len(data)
+    assert binary_replace(data, b"/missing", b"/new") is data
+    with pytest.raises(ValueError):
+        binary_replace(data, b"/old/prefix", b"/a/longer/prefix")
+
+
 def test_include_exclude(basic_python_env):
     old_len = len(basic_python_env)
     env2 = basic_python_env.exclude("*.pyc")
@@ -305,11 +401,17 @@ def test_roundtrip(tmpdir, basic_python_env):
     out = subprocess.check_output([conda_unpack, '--help'],
                                   stderr=subprocess.STDOUT).decode()
     assert out.startswith('usage: conda-unpack')
+    assert '--n-threads' in out
 
     out = subprocess.check_output([conda_unpack, '--version'],
                                   stderr=subprocess.STDOUT).decode()
     assert out.startswith('conda-unpack')
 
+    proc = subprocess.run([conda_unpack, '-j', '0'], stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+    assert proc.returncode == 2
+    assert b'n-threads must be >= 1' in proc.stderr
+
     # Check no prefix generated for python executable
     python_pattern = re.compile(r'bin/python\d.\d')
     conda_unpack_mod = load_source('conda_unpack', conda_unpack_script)
@@ -319,7 +421,7 @@ def test_roundtrip(tmpdir, basic_python_env):
 
     if on_win:
         command = (r"@call {path}\Scripts\activate.bat && "
-                   "conda-unpack.exe && "
+                   "conda-unpack.exe -j 2 && "
                    r"call {path}\Scripts\deactivate.bat && "
                    "echo Done").format(path=extract_path)
         unpack = tmpdir.join('unpack.bat')
@@ -331,13 +433,35 @@ def test_roundtrip(tmpdir, basic_python_env):
     else:
         # Check bash scripts all don't error
         command = (". {path}/bin/activate && "
-                   "conda-unpack && "
+                   "conda-unpack -j 2 && "
                    ". {path}/bin/deactivate && "
                    "echo 'Done'").format(path=extract_path)
         out = subprocess.check_output(['/usr/bin/env', 'bash', '-c', command],
                                       stderr=subprocess.STDOUT).decode()
         assert out == 'Done\n'
 
+    # Check conda-unpack rewrote the prefix in every recorded text file.
+    # Binary files only have null terminated occurrences rewritten.
+    text_records = [r for r in conda_unpack_mod._prefix_records if r[2] == 'text']
+    assert text_records
+    for path, placeholder, mode in text_records:
+        with open(os.path.join(extract_path, path), 'rb') as fil:
+            data = fil.read()
+        assert placeholder.encode('utf-8') not in data, path
+
+    def snapshot():
+        out = {}
+        for path, placeholder, mode in conda_unpack_mod._prefix_records:
+            path = os.path.join(extract_path, path)
+            with open(path, 'rb') as fil:
+                out[path] = (fil.read(), os.stat(path).st_mtime_ns)
+        return out
+
+    # Running again, on every core, finds nothing left to rewrite
+    before = snapshot()
+    subprocess.check_output([conda_unpack, '-j', '-1'], stderr=subprocess.STDOUT)
+    assert snapshot() == before
+
 
 @pytest.mark.parametrize('fix_dest', (True, False))
 def test_pack_with_conda(tmpdir, fix_dest):
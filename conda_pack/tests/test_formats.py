@@ -1,20 +1,36 @@
+import gzip
+import lzma
 import os
 import shutil
+import stat
 import subprocess
 import sys
 import tarfile
 import threading
 import time
+import types
 import zipfile
+import zlib
+from io import BytesIO
 from multiprocessing import cpu_count
 from os.path import exists, isdir, isfile, islink, join
 from subprocess import STDOUT, check_output
 
 import pytest
 
+from conda_pack import formats
 from conda_pack.compat import PY2, on_linux, on_mac, on_win
 from conda_pack.core import CondaPackException
-from conda_pack.formats import _parse_n_threads, archive
+from conda_pack.formats import (
+    ParallelGzipFileWriter,
+    ParallelXZFileWriter,
+    _crc32_combine,
+    _crc32_combine_python,
+    _deflate_level,
+    _libz_crc32_combine,
+    _parse_n_threads,
+    archive,
+)
 
 
 @pytest.fixture(scope="module")
@@ -235,7 +251,24 @@ def test_n_threads():
             _parse_n_threads(n)
 
 
-@pytest.mark.parametrize('format', ['tar.gz', 'tar.bz2', 'tar.xz', 'tar.zst'])
+@pytest.mark.parametrize('length', [0, 1, 7, 256 * 2**10, 256 * 2**10 + 513])
+@pytest.mark.parametrize('impl', ['default', 'libz', 'python'])
+def test_crc32_combine(impl, length):
+    if impl == 'default':
+        crc32_combine = _crc32_combine
+    elif impl == 'libz':
+        crc32_combine = _libz_crc32_combine()
+        if crc32_combine is None:
+            pytest.skip("crc32_combine64 not found in the system zlib")
+    else:
+        crc32_combine = _crc32_combine_python
+    first = os.urandom(1000)
+    second = os.urandom(length)
+    combined = crc32_combine(zlib.crc32(first), zlib.crc32(second), length)
+    assert combined == zlib.crc32(first + second)
+
+
+@pytest.mark.parametrize('format', ['zip', 'tar.gz', 'tar.bz2', 'tar.xz', 'tar.zst'])
 def test_format_parallel(tmpdir, format, root_and_paths):
     # Python 2's bzip dpesn't support reading multipart files :(
     if format == 'tar.bz2' and PY2:
@@ -269,10 +302,161 @@ def test_format_parallel(tmpdir, format, root_and_paths):
     if format == "tar.zst":
         decompress_zstd_inplace(out_path)
 
-    if use_cli_to_extract:
+    if format == 'zip':
+        with zipfile.ZipFile(out_path) as out:
+            out.extractall(out_dir)
+    elif use_cli_to_extract:
         check_output(['tar', '-xf', out_path, '-C', out_dir])
     else:
         with tarfile.open(out_path) as out:
             out.extractall(out_dir)
 
-    check(out_dir, links=(not on_win), root=root)
+    check(out_dir, links=(not on_win and format != 'zip'), root=root)
+
+
+@pytest.mark.parametrize('can_write_deflated', [True, False])
+def test_zip_parallel_entries(tmpdir, monkeypatch, can_write_deflated):
+    if not can_write_deflated:
+        # A python whose zipfile internals differ falls back to ZipFile.write
+        monkeypatch.setattr(formats, '_can_write_deflated', lambda: False)
+    written = []
+    write_deflated = formats.ZipArchive._write_deflated
+
+    def spy(self, info, result):
+        written.append(info.filename)
+        write_deflated(self, info, result)
+
+    monkeypatch.setattr(formats.ZipArchive, '_write_deflated', spy)
+
+    contents = {'empty': b'',
+                'small': b'foo bar',
+                'random': os.urandom(300000),
+                'repeated': os.urandom(1000) * 300}
+    for name, data in contents.items():
+        with open(join(str(tmpdir), name), 'wb') as fil:
+            fil.write(data)
+
+    # Symlinks are written straight away, so add one after each file to
+    # check that entries still come out in the order they were added
+    links = {}
+    if not on_win:
+        for name in contents:
+            os.symlink(name, join(str(tmpdir), 'link_' + name))
+            links['link_' + name] = name
+    added = []
+    for name in contents:
+        added.append(name)
+        if links:
+            added.append('link_' + name)
+
+    out_path = join(str(tmpdir), 'test.zip')
+    with open(out_path, mode='wb') as fil:
+        with archive(fil, out_path, '', 'zip', zip_symlinks=True, n_threads=2) as arc:
+            for name in added:
+                arc.add(join(str(tmpdir), name), name)
+
+    assert sorted(written) == (sorted(contents) if can_write_deflated else [])
+    with zipfile.ZipFile(out_path) as out:
+        assert out.testzip() is None
+        assert [info.filename for info in out.infolist()] == added
+        for info in out.infolist():
+            if info.filename in links:
+                assert stat.S_ISLNK(info.external_attr >> 16)
+                assert out.read(info) == links[info.filename].encode()
+                continue
+            data = contents[info.filename]
+            assert info.compress_type == zipfile.ZIP_DEFLATED
+            assert info.CRC == zlib.crc32(data)
+            assert info.file_size == len(data)
+            assert out.read(info) == data
+
+
+@pytest.fixture(params=['zlib', 'zlib_ng', 'isal'])
+def zlib_backend(request, monkeypatch):
+    """Run a test with each deflate backend formats can pick at import"""
+    if request.param == 'zlib':
+        module = zlib
+    elif request.param == 'zlib_ng':
+        module = pytest.importorskip('zlib_ng.zlib_ng')
+    else:
+        module = pytest.importorskip('isal.isal_zlib')
+    monkeypatch.setattr(formats, '_zlib', module)
+    monkeypatch.setattr(formats, '_crc32_combine',
+                        getattr(module, 'crc32_combine',
+                                formats._crc32_combine_fallback))
+    return module
+
+
+def test_deflate_level(monkeypatch):
+    monkeypatch.setattr(formats, '_zlib', zlib)
+    assert [_deflate_level(i) for i in range(10)] == list(range(10))
+
+    # ISA-L only has levels 0-3
+    monkeypatch.setattr(formats, '_zlib', types.SimpleNamespace(ISAL_BEST_COMPRESSION=3))
+    assert [_deflate_level(i) for i in range(10)] == [0, 0, 0, 1, 1, 2, 2, 2, 3, 3]
+
+
+@pytest.mark.parametrize('n_threads', [1, 3])
+@pytest.mark.parametrize('compresslevel', [1, 9])
+def test_parallel_gzip_backends(zlib_backend, n_threads, compresslevel):
+    block_size = ParallelGzipFileWriter._block_size
+    # Repetitive data, so blocks lean on the dictionary primed from the
+    # previous block, followed by incompressible data
+    data = os.urandom(1000) * (2 * block_size // 1000) + os.urandom(block_size + 12345)
+
+    out = BytesIO()
+    writer = ParallelGzipFileWriter(out, compresslevel=compresslevel,
+                                    n_threads=n_threads)
+    # Odd sized writes straddle the block boundaries
+    for start in range(0, len(data), 70001):
+        writer.write(data[start:start + 70001])
+    writer.close()
+
+    # gzip verifies the crc32 and size in the footer
+    assert gzip.decompress(out.getvalue()) == data
+
+
+def test_parallel_gzip_backends_small(zlib_backend):
+    out = BytesIO()
+    writer = ParallelGzipFileWriter(out, compresslevel=4, n_threads=2)
+    writer.write(b"foo bar")
+    writer.close()
+    assert gzip.decompress(out.getvalue()) == b"foo bar"
+
+
+def test_parallel_writer_block_allocation():
+    # The first block grows with the data, rather than allocating a whole
+    # block (128 MiB for xz at level 9) up front
+    out = BytesIO()
+    writer = ParallelXZFileWriter(out, compresslevel=9, n_threads=2)
+    writer.write(b"foo bar")
+    assert len(writer.buffer) == 7
+    writer.close()
+    assert lzma.decompress(out.getvalue()) == b"foo bar"
+
+    # Only full blocks are recycled
+    block_size = ParallelGzipFileWriter._block_size
+    data = os.urandom(3 * block_size + 100)
+    out = BytesIO()
+    writer = ParallelGzipFileWriter(out, compresslevel=1, n_threads=2)
+    writer.write(data)
+    while writer._pending:
+        writer._write_result()
+    assert writer._free_blocks
+    assert all(len(block) == block_size for block in writer._free_blocks)
+    writer.close()
+    assert gzip.decompress(out.getvalue()) == data
+
+
+def test_parallel_zip_backends(tmpdir, zlib_backend, root_and_paths):
+    root, paths = root_and_paths
+    out_path = join(str(tmpdir), 'test.zip')
+    with open(out_path, mode='wb') as fil:
+        with archive(fil, out_path, '', 'zip', n_threads=2) as arc:
+            for rel in paths:
+                arc.add(join(root, rel), rel)
+
+    with zipfile.ZipFile(out_path) as out:
+        assert out.testzip() is None
+        with open(join(root, 'file'), 'rb') as fil:
+            assert out.read('file') == fil.read()